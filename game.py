@@ -1,138 +1,125 @@
-from mcts import MonteCarloTree, MonteCarloTreeNode
+from mcts import MonteCarloTree, MonteCarloTreeNode, TreeDrawer
 import numpy as np
-from graphviz import Digraph
-
-class TreeDrawer():
-    def __init__(self):
-        self.frame = 0
-
-    def draw(self, tree, filename: str = "mcts_tree") -> None:
-        dot = Digraph(comment='Monte Carlo Tree')
-        dot.attr('node', shape='box', style='filled', fillcolor='lightblue')
-        dot.attr('edge', fontsize='10')
-
-        # Mark the select route
-        curr = tree.root
-        select_route = []
-        while len(curr.children) > 0:
-            curr = curr.select(tree.root.visit)
-            select_route.append(curr)
-
-        # Add nodes recursively
-        def add_nodes(node: MonteCarloTreeNode) -> None:
-            label = f"Visits: {node.visit}\nScore: {node.score:.2f}"
-            if node.visit > 0:
-                label += f"\nAvg: {node.score/node.visit:.2f}"
-            label += '\n' + str(node)
-
-            node_id = str(id(node))
-            dot.node(node_id, label)
-
-            if node is tree.root:
-                # Root node style
-                dot.node(node_id, label, style='filled', fillcolor='gold')
-            elif node.is_terminal:
-                # Terminal node style
-                dot.node(node_id, label, style='filled', fillcolor='salmon')
-            elif node in select_route:
-                # Selected node style
-                dot.node(node_id, label, style='filled', fillcolor='lightgreen')
-
-            for child in node.children:
-                child_id = str(id(child))
-                ucb1 = "INF" if child.visit == 0 else f"{child.ucb1(node.visit):.4f}"
-                dot.edge(node_id, child_id, label=ucb1)
-                add_nodes(child)
-        add_nodes(tree.root)
-
-        dot.graph_attr['dpi'] = str(300)
-        dot.format = 'pdf'
-        dot.render(f"{filename}_{self.frame}", view=False, cleanup=True)
-        print(f"Save {filename}_{self.frame}.pdf")
-        self.frame += 1
+import random
+from numba import njit
+
+# Bit (3 * i + j) of a mask is the cell (i, j)
+LINES = (0o007, 0o070, 0o700, 0o111, 0o222, 0o444, 0o421, 0o124)
+
+# A state index encodes the board in base 3, digit (3 * i + j) is the cell (i, j)
+# with 0 for empty, 1 for X and 2 for O
+N_STATES = 3 ** 9
+POW3 = tuple(3 ** i for i in range(9))
+
+def _build_tables() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Enumerate every state index once, unreachable ones included
+    cells = np.arange(N_STATES)[:, None] // np.array(POW3) % 3
+    bits = 1 << np.arange(9)
+    x_mask = (cells == 1) @ bits
+    o_mask = (cells == 2) @ bits
+
+    winner = np.full(N_STATES, -1, dtype=np.int8)
+    for line in LINES:
+        winner[(o_mask & line) == line] = 1
+    for line in LINES:
+        winner[(x_mask & line) == line] = 0
+
+    empty_count = (cells == 0).sum(axis=1).astype(np.int8)
+    # A stable sort moves the empty cells to the front, in increasing order
+    empty_cells = np.argsort(cells != 0, axis=1, kind='stable').astype(np.int8)
+    terminal = (winner != -1) | (empty_count == 0)
+    return winner, terminal, empty_count, empty_cells
+
+# WINNER is 0 for X, 1 for O and -1 for none, EMPTY_CELLS[s, :EMPTY_COUNT[s]] are the free cells
+WINNER, TERMINAL, EMPTY_COUNT, EMPTY_CELLS = _build_tables()
+
+@njit("int64(int64, int64)", cache=True, nogil=True)
+def _simulate(state, player):
+    # Random playout from a non-terminal state, scored for the player
+    # who is not to move at the start
+    last_player = player ^ 1
+    # Each ply fills one cell, and only that move can complete a line
+    for n_empty in range(EMPTY_COUNT[state], 0, -1):
+        cell = EMPTY_CELLS[state, random.randrange(n_empty)]
+        state += (player + 1) * POW3[cell]
+        winner = WINNER[state]
+        if winner != -1:
+            return 1 if winner == last_player else -1
+        player ^= 1
+    return 0
+
+@njit("void(int64)", cache=True)
+def _seed(seed):
+    # Numba keeps its own random state, separate from the interpreter's
+    random.seed(seed)
 
 class TicTacToeNode(MonteCarloTreeNode):
-    SYMBOLS = {0: 'X', 1: 'O', None: '.'}
+    # Indexed by the cell values of board: X=0, O=1, empty=2
+    SYMBOLS = ('X', 'O', '.')
+    # Let move orders reaching the same board share a node, see key()
+    share_transpositions: bool = False
 
-    def __init__(self, current_player: int, board: np.ndarray = None):
-        super().__init__(current_player)
-        self.board = board if board is not None else np.full((3, 3), None)
+    __slots__ = ('state_idx', 'current_player', 'winner')
+
+    def __init__(self, current_player: int, state_idx: int = 0):
+        super().__init__()
+        self.state_idx = state_idx
         self.current_player = current_player
 
-        self.winner = self.check_winner(self.board)
-        if (self.winner is not None) or (not None in self.board):
+        self.winner = self.check_winner()
+        if TERMINAL[state_idx]:
             self.is_terminal = True
 
-    def check_winner(self, board) -> int:
-        # Check if the game is over and return the winner, None if no winner
-        for i in range(3):
-            if board[i, 0] == board[i, 1] == board[i, 2] is not None:
-                return board[i, 0]
+    def seed(self, seed: int) -> None:
+        super().seed(seed)
+        _seed(seed)
 
-        for j in range(3):
-            if board[0, j] == board[1, j] == board[2, j] is not None:
-                return board[0, j]
+    def is_free(self, bit: int) -> bool:
+        return self.state_idx // POW3[bit] % 3 == 0
 
-        if board[0, 0] == board[1, 1] == board[2, 2] is not None:
-            return board[0, 0]
-        if board[0, 2] == board[1, 1] == board[2, 0] is not None:
-            return board[0, 2]
+    @property
+    def board(self) -> bytearray:
+        # Flat view for display, cell (i, j) is board[3 * i + j] with X=0, O=1 and empty=2
+        board = bytearray(9)
+        digits = self.state_idx
+        for bit in range(9):
+            digits, cell = divmod(digits, 3)
+            board[bit] = (cell + 2) % 3
+        return board
 
-        return None
+    def check_winner(self) -> int:
+        # Return the winner, None if no winner
+        winner = WINNER[self.state_idx]
+        return None if winner == -1 else int(winner)
 
-    def expand(self) -> list["TicTacToeNode"]:
-        children = []
-        for i in range(3):
-            for j in range(3):
-                if self.board[i, j] is None:
-                    new_board = self.board.copy()
-                    new_board[i, j] = self.current_player
-                    child = TicTacToeNode(1 - self.current_player, new_board)
-                    children.append(child)
-        return children
+    def play(self, bit: int) -> "TicTacToeNode":
+        # Return the node reached by the current player taking the given cell
+        return TicTacToeNode(self.current_player ^ 1, self.state_idx + (self.current_player + 1) * POW3[bit])
 
-    def simulate(self) -> float:
-        board = self.board.copy()
-        current_player = self.current_player
+    def expand(self) -> list[int]:
+        # Children are built lazily from the free cells
+        return EMPTY_CELLS[self.state_idx, :EMPTY_COUNT[self.state_idx]].tolist()
 
-        # The game is draw
-        winner = self.check_winner(board)
-        if winner is None and None not in board:
-            return 0
+    def make_child(self, move: int) -> "TicTacToeNode":
+        return self.play(move)
 
-        # Random play
-        while True:
-            # Find all empty positions
-            empty_positions = []
-            for i in range(3):
-                for j in range(3):
-                    if board[i, j] is None:
-                        empty_positions.append((i, j))
-            if not empty_positions:
-                break
-
-            # Randomly select a position
-            i, j = empty_positions[np.random.randint(len(empty_positions))]
-            board[i, j] = current_player
-            current_player = 1 - current_player
-
-            # Check for victory
-            winner = self.check_winner(board)
-            if winner is not None:
-                break
-
-        if winner is None:
-            return 0
-        elif winner == current_player:
-            return 1
-        else:
-            return -1
+    def key(self) -> int:
+        # The player to move follows from the board. Off by default: sharing costs more time
+        # per iteration than it saves iterations on a game this small
+        return self.state_idx if TicTacToeNode.share_transpositions else None
+
+    def simulate(self) -> float:
+        # The result is scored for the player who moved into this node
+        if self.is_terminal:
+            return 0 if self.winner is None else 1
+        return _simulate(self.state_idx, self.current_player)
 
     def __str__(self):
+        board = self.board
         s = ""
         for i in range(3):
             for j in range(3):
-                s += TicTacToeNode.SYMBOLS[self.board[i, j]] + " "
+                s += TicTacToeNode.SYMBOLS[board[3 * i + j]] + " "
             s += "\n"
         return s
 
@@ -144,7 +131,7 @@ class TicTacToeGame:
         self.player_first = player_first
         self.player_second = player_second
         self.iterations = iterations
-        self.drawer = TreeDrawer()
+        self.drawer = TreeDrawer(show_state=True)
         self.reset()
 
     def reset(self):
@@ -157,8 +144,8 @@ class TicTacToeGame:
             return
         print(f"Current board (Round {self.round}, {player} move):")
         print(self.current_node)
-        winner = self.current_node.check_winner(self.current_node.board)
-        if winner is None and None not in self.current_node.board:
+        winner = self.current_node.winner
+        if winner is None and self.current_node.is_terminal:
             print("Game over! Draw!")
         elif winner == 0:
             print("X wins!")
@@ -178,14 +165,12 @@ class TicTacToeGame:
                 print("Invalid move! Please enter row and column as two numbers (1-3).")
                 continue
 
-            if self.current_node.board[i - 1, j - 1] is not None:
+            bit = (i - 1) * 3 + (j - 1)
+            if not self.current_node.is_free(bit):
                 print("This position is already occupied!")
                 continue
 
-            new_board = self.current_node.board.copy()
-            new_board[i - 1, j - 1] = self.current_node.current_player
-            new_node = TicTacToeNode(1 - self.current_node.current_player, new_board)
-            return new_node
+            return self.current_node.play(bit)
 
     def ai_move(self):
         best_child = self.tree.search(iterations=self.iterations)
@@ -253,7 +238,7 @@ if __name__ == "__main__":
         for i in range(batch_size):
             game = TicTacToeGame(player1, player2, iterations)
             game.play()
-            winner = game.current_node.check_winner(game.current_node.board)
+            winner = game.current_node.winner
             if winner is None:
                 draws += 1
             elif winner == 0:
@@ -1,69 +1,319 @@
 from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from threading import Lock
 from time import time
-from graphviz import Digraph
+from numba import njit
+import numpy as np
+import random
+import os
 import math
 
 class MonteCarloTreeNode(ABC):
     exploration_weight: float = 1.0
+    # Score subtracted per search thread currently passing through a child
+    virtual_loss: float = 3.0
+
+    __slots__ = ('is_terminal', 'minmax_search', 'arena', 'node_id')
 
     def __init__(self, minmax_search: bool = True):
-        self.visit = 0
-        self.score = 0
-        self.children = []
         self.is_terminal = False
-        self.parent: MonteCarloTreeNode = None
         self.minmax_search = minmax_search
 
+        # The statistics live in the arena of the tree the node belongs to
+        self.arena: NodeArena = None
+        self.node_id = -1
+
+    def __getstate__(self) -> dict:
+        # Nodes are pickled on their own, without the tree they belong to
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                state[name] = getattr(self, name)
+        state["arena"] = None
+        state["node_id"] = -1
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def visit(self) -> int:
+        return 0 if self.arena is None else int(self.arena.visits[self.node_id])
+
+    @property
+    def score(self) -> float:
+        return 0.0 if self.arena is None else float(self.arena.scores[self.node_id])
+
+    @property
+    def parent(self) -> "MonteCarloTreeNode":
+        if self.arena is None or self.arena.parent[self.node_id] == -1:
+            return None
+        return self.arena.nodes[self.arena.parent[self.node_id]]
+
+    @property
+    def children(self) -> list:
+        # Children that were never selected are still moves, see make_child()
+        if self.arena is None:
+            return []
+        first = self.arena.first_child[self.node_id]
+        return self.arena.nodes[first:first + self.arena.num_children[self.node_id]]
+
     @abstractmethod
-    def expand(self) -> list["MonteCarloTreeNode"]:
+    def expand(self) -> list:
+        # Returns the children, either as nodes or as moves to be built lazily by make_child()
         raise NotImplementedError("Expand method must be implemented by subclasses.")
 
+    def make_child(self, move) -> "MonteCarloTreeNode":
+        raise NotImplementedError("Make child method must be implemented by subclasses whose expand returns moves.")
+
+    def key(self):
+        # Hashable position key, nodes with equal keys share one set of statistics within a tree.
+        # None disables this. Keyed positions must not be able to repeat along a line of play.
+        return None
+
     @abstractmethod
     def simulate(self) -> float:
         raise NotImplementedError("Simulate method must be implemented by subclasses.")
 
+    def seed(self, seed: int) -> None:
+        # Seed the random sources used by simulate(), e.g. in a search worker process
+        random.seed(seed)
+        np.random.seed(seed)
+
     def expand_node(self) -> None:
-        self.children = self.expand()
-        if len(self.children) == 0:
-            self.is_terminal = True
+        arena = self.arena
+        if arena is None:
+            # Not part of a tree, there is nowhere to keep the children
+            if len(self.expand()) == 0:
+                self.is_terminal = True
             return
-
-        for child in self.children:
-            child.parent = self
-
-    def backpropagate(self, result: float) -> None:
-        self.visit += 1
-        self.score += result
-        if self.parent:
-            self.parent.backpropagate(-result if self.minmax_search else result)
+        with arena.lock:
+            # Another thread may have expanded it meanwhile
+            if arena.num_children[self.node_id] > 0 or self.is_terminal:
+                return
+            children = self.expand()
+            if len(children) == 0:
+                self.is_terminal = True
+                return
+            arena.add_children(self.node_id, children)
 
     def select(self, N: int) -> "MonteCarloTreeNode":
-        if len(self.children) == 0:
+        arena = self.arena
+        if arena is None or arena.num_children[self.node_id] == 0:
             return self
 
-        best_child = self.children[0]
-        best_ucb1 = best_child.ucb1(N)
-
-        for child in self.children:
-            if child.visit == 0:
-                return child
-            ucb1 = child.ucb1(N)
-            if ucb1 > best_ucb1:
-                best_ucb1 = ucb1
-                best_child = child
-
-        return best_child
+        exploration = _exploration_factor(N, MonteCarloTreeNode.exploration_weight)
+        slot = _select_child(arena.visits, arena.scores, arena.virtual_loss, arena.target, arena.first_child,
+                             arena.num_children, self.node_id, exploration, MonteCarloTreeNode.virtual_loss)
+        return arena.node(slot)
 
     def ucb1(self, N: int) -> float:
         if self.visit == 0:
             return float('inf')
-        return (self.score / self.visit) + MonteCarloTreeNode.exploration_weight * (math.log(N) / self.visit)
+        return (self.score / self.visit) + MonteCarloTreeNode.exploration_weight * math.sqrt(math.log(N) / self.visit)
+
+class NodeArena:
+    # Struct-of-arrays storage of the tree statistics, indexed by node id.
+    # The children of a node have consecutive ids starting at first_child. A child whose
+    # position was already reached through another path links to it through target.
+    def __init__(self, capacity: int):
+        # Initial number of nodes, the arrays are doubled whenever they fill up
+        capacity = max(capacity, 1)
+        self.initial_capacity = capacity
+        self.capacity = capacity
+        self.size = 0
+        self.visits = np.zeros(capacity, dtype=np.int32)
+        self.scores = np.zeros(capacity, dtype=np.float64)
+        self.virtual_loss = np.zeros(capacity, dtype=np.int32)
+        self.parent = np.empty(capacity, dtype=np.int32)
+        self.first_child = np.empty(capacity, dtype=np.int32)
+        self.num_children = np.zeros(capacity, dtype=np.int32)
+        self.minmax_search = np.zeros(capacity, dtype=np.bool_)
+        self.target = np.empty(capacity, dtype=np.int32)
+        # A node, or the move to build it from while it has not been selected yet
+        self.nodes: list = []
+        # Node id of each keyed position, see MonteCarloTreeNode.key()
+        self.transpositions: dict = {}
+
+        # Guards allocation and the nodes list during threaded search
+        self.lock = Lock()
+
+    def _grow(self, size: int) -> None:
+        # Called with the lock held. The kernels are passed the arrays on every call, so replacing them is enough
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        for name in ('visits', 'scores', 'virtual_loss', 'parent', 'first_child', 'num_children', 'minmax_search',
+                     'target'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def _allocate(self, count: int, parent: int) -> int:
+        first = self.size
+        if first + count > self.capacity:
+            self._grow(first + count)
+        self.size += count
+        self.parent[first:first + count] = parent
+        self.first_child[first:first + count] = -1
+        self.target[first:first + count] = np.arange(first, first + count)
+        return first
+
+    def _attach(self, node: MonteCarloTreeNode, node_id: int) -> MonteCarloTreeNode:
+        # Returns the node now standing at node_id, which is the existing one for a known position
+        key = node.key()
+        if key is not None:
+            existing = self.transpositions.get(key)
+            if existing is not None:
+                self.target[node_id] = existing
+                node = self.nodes[existing]
+                self.nodes[node_id] = node
+                return node
+            self.transpositions[key] = node_id
+
+        if node.arena is not None and node.arena is not self:
+            raise ValueError("The node already belongs to another tree.")
+        node.arena = self
+        node.node_id = node_id
+        self.minmax_search[node_id] = node.minmax_search
+        self.nodes[node_id] = node
+        return node
+
+    def add_root(self, node: MonteCarloTreeNode) -> int:
+        node_id = self._allocate(1, -1)
+        self.nodes.append(None)
+        self._attach(node, node_id)
+        return node_id
+
+    def add_children(self, parent: int, children: list) -> None:
+        first = self._allocate(len(children), parent)
+        self.nodes.extend(children)
+        for node_id, child in enumerate(children, first):
+            if isinstance(child, MonteCarloTreeNode):
+                self._attach(child, node_id)
+        # Publish the children last, other threads select as soon as num_children is set
+        self.first_child[parent] = first
+        self.num_children[parent] = len(children)
+
+    def node(self, node_id: int) -> MonteCarloTreeNode:
+        # Build the node on first access if expand() returned a move
+        node = self.nodes[node_id]
+        if isinstance(node, MonteCarloTreeNode):
+            return node
+        with self.lock:
+            node = self.nodes[node_id]
+            if not isinstance(node, MonteCarloTreeNode):
+                node = self._attach(self.nodes[self.parent[node_id]].make_child(node), node_id)
+        return node
+
+    def _detach(self, node) -> None:
+        # Let the node be attached to another arena, shared nodes may already have been moved
+        if isinstance(node, MonteCarloTreeNode) and node.arena is self:
+            node.arena = None
+            node.node_id = -1
+
+    def subtree(self, root_id: int) -> "NodeArena":
+        # Copy the subtree under root_id into a new arena, with root_id as its root
+        arena = NodeArena(self.initial_capacity)
+        self._detach(self.nodes[root_id])
+        arena.add_root(self.nodes[root_id])
+        arena.visits[0] = self.visits[root_id]
+        arena.scores[0] = self.scores[root_id]
+
+        queue = [(root_id, 0)]
+        for old_id, new_id in queue:
+            count = self.num_children[old_id]
+            if count == 0:
+                continue
+            old_first = self.first_child[old_id]
+            children = self.nodes[old_first:old_first + count]
+            for child in children:
+                self._detach(child)
+            arena.add_children(new_id, children)
+            new_first = arena.first_child[new_id]
+            for k in range(count):
+                # Links are re-resolved by the new arena, copy each shared position only once
+                old_child = self.target[old_first + k]
+                new_child = arena.target[new_first + k]
+                if new_child == new_first + k:
+                    arena.visits[new_child] = self.visits[old_child]
+                    arena.scores[new_child] = self.scores[old_child]
+                    queue.append((old_child, new_child))
+        return arena
+
+@njit(cache=True)
+def _exploration_factor(N, exploration_weight):
+    # exploration_weight * sqrt(ln N / n) is this factor divided by sqrt(n)
+    return exploration_weight * math.sqrt(math.log(N)) if N > 1 else 0.0
+
+@njit(cache=True)
+def _select_child(visits, scores, virtual_loss, target, first_child, num_children, node_id, exploration,
+                  virtual_loss_weight):
+    # UCB1 over the children of node_id, the first unvisited child wins outright.
+    # Children being searched by other threads count as extra visits that were lost.
+    # Returns the id of the child slot, its statistics are those of target[slot].
+    first = first_child[node_id]
+    best_slot = first
+    best_ucb1 = -np.inf
+    for slot in range(first, first + num_children[node_id]):
+        child = target[slot]
+        visit = visits[child] + virtual_loss[child]
+        if visit == 0:
+            return slot
+        score = scores[child] - virtual_loss_weight * virtual_loss[child]
+        ucb1 = score / visit + exploration / math.sqrt(visit)
+        if ucb1 > best_ucb1:
+            best_ucb1 = ucb1
+            best_slot = slot
+    return best_slot
+
+@njit(cache=True)
+def _descend(visits, scores, virtual_loss, target, first_child, num_children, path, depth,
+             exploration_weight, virtual_loss_weight):
+    # Follow select() from path[depth - 1] down to a node without children, recording the
+    # nodes passed in path, and return the new depth. Stops early when only one slot of path
+    # is left, that one is kept for the child search_iter() adds after an expansion.
+    # N is the root visit count at every depth, so the exploration factor is computed once
+    exploration = _exploration_factor(visits[path[0]], exploration_weight)
+    node_id = path[depth - 1]
+    while num_children[node_id] > 0 and depth + 1 < len(path):
+        slot = _select_child(visits, scores, virtual_loss, target, first_child, num_children, node_id,
+                             exploration, virtual_loss_weight)
+        node_id = target[slot]
+        path[depth] = node_id
+        depth += 1
+    return depth
+
+@njit(cache=True)
+def _add_virtual_loss(virtual_loss, path, depth, count):
+    for i in range(depth):
+        virtual_loss[path[i]] += count
+
+@njit(cache=True)
+def _backpropagate_path(visits, scores, virtual_loss, minmax_search, path, depth, result, virtual_loss_count):
+    # Along the recorded path rather than the parent links, so a shared position
+    # credits the parent it was actually reached from. Also takes virtual_loss_count back off the path
+    for i in range(depth - 1, -1, -1):
+        node_id = path[i]
+        visits[node_id] += 1
+        scores[node_id] += result
+        virtual_loss[node_id] -= virtual_loss_count
+        if minmax_search[node_id]:
+            result = -result
 
 class MonteCarloTree(ABC):
-    def __init__(self, root: MonteCarloTreeNode):
+    def __init__(self, root: MonteCarloTreeNode, capacity: int = 1 << 16):
+        # capacity is only the initial size of the node arena, it grows as the tree does
         self.root = root
+        self.arena = NodeArena(capacity)
+        self.arena.add_root(root)
 
-    def search(self, iterations: int = None, time_limit: float = None) -> MonteCarloTreeNode:
+    def search(self, iterations: int = None, time_limit: float = None, threads: int = 1) -> MonteCarloTreeNode:
         # This method performs the MCTS search, returns the best node after the search is complete.
         if iterations is None and time_limit is None:
             raise ValueError("Either iterations or time_limit must be specified.")
@@ -73,40 +323,121 @@ class MonteCarloTree(ABC):
             raise ValueError("Time limit must be greater than zero.")
         if iterations and iterations <= 0:
             raise ValueError("Number of iterations must be greater than zero.")
+        if threads <= 0:
+            raise ValueError("Number of threads must be greater than zero.")
 
-        def search_iter(curr: MonteCarloTreeNode) -> MonteCarloTreeNode:
-            while len(curr.children) > 0:
-                curr = curr.select(self.root.visit)
-            if not curr.is_terminal and curr.visit != 0:
+        arena = self.arena
+        root_id = self.root.node_id
+        exploration_weight = MonteCarloTreeNode.exploration_weight
+        virtual_loss = MonteCarloTreeNode.virtual_loss
+
+        def search_iter(path: np.ndarray) -> np.ndarray:
+            # path starts at the root. Returns the path buffer for the next iteration, it may have grown
+            depth = 1
+            while True:
+                depth = _descend(arena.visits, arena.scores, arena.virtual_loss, arena.target,
+                                 arena.first_child, arena.num_children, path, depth,
+                                 exploration_weight, virtual_loss)
+                if depth + 1 == len(path):
+                    # The descent ran out of room, continue it with a longer path
+                    path = np.concatenate((path, np.empty_like(path)))
+                    continue
+                node_id = path[depth - 1]
+                curr = arena.node(node_id)
+                if curr.node_id != node_id:
+                    # The position was already in the tree, carry on from the shared node
+                    path[depth - 1] = curr.node_id
+                    continue
+                if curr.is_terminal or arena.visits[node_id] == 0:
+                    break
                 curr.expand_node()
-                if not curr.is_terminal:
-                    curr = curr.children[0]
+                if curr.is_terminal:
+                    break
+                # The children are all unvisited, so select() would take the first one. Unless it is a
+                # shared position, which may have been visited, then the next descent picks the child.
+                slot = arena.first_child[node_id]
+                curr = arena.node(slot)
+                if curr.node_id == slot:
+                    path[depth] = slot
+                    depth += 1
+                    break
+
+            # Steer other threads away from this path until the result is known
+            _add_virtual_loss(arena.virtual_loss, path, depth, 1)
             score = curr.simulate()
-            curr.backpropagate(score)
+            _backpropagate_path(arena.visits, arena.scores, arena.virtual_loss, arena.minmax_search,
+                                path, depth, score, 1)
+
+            return path
 
-            return curr
+        def search_worker(count: int) -> None:
+            path = np.empty(64, dtype=np.int32)
+            path[0] = root_id
+            if iterations is not None:
+                for _ in range(count):
+                    path = search_iter(path)
+            else:
+                CHECK_ITERATIONS = 100
+                iters = 0
+                start_time = time()
+                while iters % CHECK_ITERATIONS != 0 or time() - start_time < time_limit:
+                    path = search_iter(path)
+                    iters += 1
 
-        curr = self.root
-        if iterations is not None:
-            for _ in range(iterations):
-                search_iter(curr)
+        if threads == 1:
+            search_worker(iterations)
         else:
-            CHECK_ITERATIONS = 100
-            iters = 0
-            start_time = time()
-            while iters % CHECK_ITERATIONS != 0 and time() - start_time < time_limit:
-                search_iter(curr)
-                iters += 1
+            counts = [None] * threads
+            if iterations is not None:
+                counts = [iterations // threads + (1 if i < iterations % threads else 0) for i in range(threads)]
+            with ThreadPoolExecutor(threads) as executor:
+                futures = [executor.submit(search_worker, count) for count in counts]
+            # Re-raise the error of a failed worker rather than return partial statistics
+            for future in futures:
+                future.result()
 
         # Find the best child based on visit count
-        if len(self.root.children) == 0:
+        count = arena.num_children[root_id]
+        if count == 0:
             raise ValueError("No children found in the root node. Ensure the root could be expanded.")
-        best_child = self.root.children[0]
-        for child in self.root.children[1:]:
-            if child.visit > best_child.visit:
-                best_child = child
+        first = arena.first_child[root_id]
+        return arena.node(first + int(arena.visits[arena.target[first:first + count]].argmax()))
 
-        return best_child
+    def search_parallel(self, iterations: int, workers: int = None) -> MonteCarloTreeNode:
+        # Root parallelization: each worker process searches a fresh tree from a copy of the root,
+        # the visit counts of the root children are summed to pick the best child. The workers
+        # identify the root children by index, so expand() must return them in a fixed order.
+        if iterations is None or iterations <= 0:
+            raise ValueError("Number of iterations must be greater than zero.")
+        if workers is not None and workers <= 0:
+            raise ValueError("Number of workers must be greater than zero.")
+
+        arena = self.arena
+        root_id = self.root.node_id
+        if arena.num_children[root_id] == 0 and not self.root.is_terminal:
+            self.root.expand_node()
+        count = arena.num_children[root_id]
+        if count == 0:
+            raise ValueError("No children found in the root node. Ensure the root could be expanded.")
+
+        workers = min(workers or os.cpu_count() or 1, iterations)
+        seeds = np.random.randint(0, 2**31 - 1, size=workers)
+        tasks = [(self.root, iterations // workers + (1 if i < iterations % workers else 0), int(seeds[i]))
+                 for i in range(workers)]
+        with Pool(workers) as pool:
+            results = pool.map(_search_worker, tasks)
+
+        first = arena.first_child[root_id]
+        visits = Counter(dict(enumerate(arena.visits[arena.target[first:first + count]].tolist())))
+        for result in results:
+            visits.update(result)
+
+        best_idx = 0
+        for idx in range(1, count):
+            if visits[idx] > visits[best_idx]:
+                best_idx = idx
+
+        return arena.node(first + best_idx)
 
     def move_to(self, node: MonteCarloTreeNode) -> None:
         # This method moves the root to the specified node.
@@ -115,50 +446,85 @@ class MonteCarloTree(ABC):
         if node is None:
             raise ValueError("node cannot be None.")
 
+        # Keep the statistics of the node's subtree if it is part of this tree
+        if node.arena is self.arena:
+            self.arena = self.arena.subtree(node.node_id)
+        else:
+            self.arena = NodeArena(self.arena.initial_capacity)
+            self.arena.add_root(node)
         self.root = node
-        self.root.parent = None
+
+def _search_worker(task: tuple[MonteCarloTreeNode, int, int]) -> dict[int, int]:
+    # Runs in a worker process, returns the visits of each root child by index
+    root, iterations, seed = task
+    root.seed(seed)
+    tree = MonteCarloTree(root)
+    tree.search(iterations=iterations)
+    return {idx: child.visit for idx, child in enumerate(tree.root.children)
+            if isinstance(child, MonteCarloTreeNode)}
 
 class TreeDrawer():
-    def __init__(self):
+    def __init__(self, show_state: bool = False):
         self.frame = 0
+        # Add str(node) to the node labels
+        self.show_state = show_state
 
     def draw(self, tree, filename: str = "mcts_tree") -> None:
+        # Graphviz is only needed when a tree is actually drawn
+        from graphviz import Digraph
+
         dot = Digraph(comment='Monte Carlo Tree')
         dot.attr('node', shape='box', style='filled', fillcolor='lightblue')
         dot.attr('edge', fontsize='10')
 
-        # Mark the select route
-        curr = tree.root
-        select_route = []
-        while len(curr.children) > 0:
-            curr = curr.select(tree.root.visit)
-            select_route.append(curr)
+        # Mark the select route, read from the arena so that drawing never builds nodes
+        arena = tree.arena
+        node_id = tree.root.node_id
+        exploration = _exploration_factor(arena.visits[node_id], MonteCarloTreeNode.exploration_weight)
+        select_route = set()
+        while arena.num_children[node_id] > 0:
+            slot = _select_child(arena.visits, arena.scores, arena.virtual_loss, arena.target, arena.first_child,
+                                 arena.num_children, node_id, exploration, MonteCarloTreeNode.virtual_loss)
+            node_id = int(arena.target[slot])
+            select_route.add(node_id)
 
-        # Add nodes recursively
-        def add_nodes(node: MonteCarloTreeNode) -> None:
-            label = f"Visits: {node.visit}\nScore: {node.score:.2f}"
+        # Emit the DOT statements as raw lines, much cheaper than a dot.node()/dot.edge() call each
+        lines = []
+        # Depth-first walk with an explicit stack, deep trees would overflow the recursion limit
+        stack = [(tree.root, str(id(tree.root)))]
+        # Positions shared by several parents are drawn once
+        drawn = {tree.root}
+        while stack:
+            node, node_id = stack.pop()
+            label = f"Visits: {node.visit}\\nScore: {node.score:.2f}"
             if node.visit > 0:
-                label += f"\nAvg: {node.score/node.visit:.2f}"
-
-            node_id = str(id(node))
-            dot.node(node_id, label)
+                label += f"\\nAvg: {node.score/node.visit:.2f}"
+            if self.show_state:
+                label += "\\n" + str(node).replace('\\', '\\\\').replace('"', '\\"').replace("\n", "\\n")
 
+            attrs = f'label="{label}"'
             if node is tree.root:
                 # Root node style
-                dot.node(node_id, label, style='filled', fillcolor='gold')
+                attrs += ' fillcolor="gold"'
             elif node.is_terminal:
                 # Terminal node style
-                dot.node(node_id, label, style='filled', fillcolor='salmon')
-            elif node in select_route:
+                attrs += ' fillcolor="salmon"'
+            elif node.node_id in select_route:
                 # Selected node style
-                dot.node(node_id, label, style='filled', fillcolor='lightgreen')
+                attrs += ' fillcolor="lightgreen"'
+            lines.append(f'\t{node_id} [{attrs}]\n')
 
             for child in node.children:
+                if not isinstance(child, MonteCarloTreeNode):
+                    # Never visited, so not built yet
+                    continue
                 child_id = str(id(child))
                 ucb1 = "INF" if child.visit == 0 else f"{child.ucb1(node.visit):.4f}"
-                dot.edge(node_id, child_id, label=ucb1)
-                add_nodes(child)
-        add_nodes(tree.root)
+                lines.append(f'\t{node_id} -> {child_id} [label="{ucb1}"]\n')
+                if child not in drawn:
+                    drawn.add(child)
+                    stack.append((child, child_id))
+        dot.body.extend(lines)
 
         dot.graph_attr['dpi'] = str(300)
         dot.format = 'pdf'